@@ -0,0 +1,38 @@
+"""Fused heat loss kernels, compiled with numba when it is available"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None # fall back to separate numpy radiation/convection passes
+
+# all fast-math flags except 'nnan'/'ninf': readings below ambient give NaN convection, which must stay NaN
+FASTMATH_FLAGS = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+def natural_heat_loss(T, Ta, Ta4, rad_coef, conv_coef):
+    """Radiation, natural convection and total heat loss (kcal/hr) in a single pass over temperatures"""
+    rad = np.empty_like(T)
+    conv = np.empty_like(T)
+    total = np.empty_like(T)
+    for i in range(T.shape[0]):
+        t = T[i]
+        rad[i] = rad_coef * (t**4 - Ta4)
+        conv[i] = conv_coef * ((t + Ta) * 0.5)**-0.724 * (t - Ta)**1.333
+        total[i] = rad[i] + conv[i]
+    return rad, conv, total
+
+def forced_heat_loss(T, Ta, Ta4, rad_coef, conv_coef):
+    """Radiation, forced convection and total heat loss (kcal/hr) in a single pass over temperatures"""
+    rad = np.empty_like(T)
+    conv = np.empty_like(T)
+    total = np.empty_like(T)
+    for i in range(T.shape[0]):
+        t = T[i]
+        rad[i] = rad_coef * (t**4 - Ta4)
+        conv[i] = conv_coef * t**-0.351 * (t - Ta)
+        total[i] = rad[i] + conv[i]
+    return rad, conv, total
+
+if njit is not None:
+    natural_heat_loss = njit(cache=True, fastmath=FASTMATH_FLAGS)(natural_heat_loss)
+    forced_heat_loss = njit(cache=True, fastmath=FASTMATH_FLAGS)(forced_heat_loss)
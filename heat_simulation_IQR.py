@@ -1,9 +1,20 @@
 import streamlit as st
+import altair as alt
 import pandas as pd
+import numpy as np
 import math
-import base64
+import io
+import importlib.util
+
+# Rust based calamine engine is much faster than openpyxl, None lets pandas pick engine based on file type
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') is not None else None
+
+# fused kernels live in an imported module so their numba dispatchers survive streamlit reruns
+from heat_loss_kernels import njit, natural_heat_loss, forced_heat_loss
 
 STEFAN_BOLTZMANN_CONSTANT = 5.67 * 10**-8
+MIN_READINGS_FOR_IQR = 4 # fewer readings than this give degenerate quartiles
+HEATMAP_ROWS_LIMIT = 200 # Styler builds html per cell, so style only this many rows
 
 # hide Hamburger menu and "Made with Streamlit" footer
 hide_streamlit_style = """
@@ -14,14 +25,36 @@ hide_streamlit_style = """
 """
 st.markdown(hide_streamlit_style, unsafe_allow_html=True)
 
-def df_to_link(df, title='Download csv', filename='download.csv'):
-    """Generates a link allowing the data in a given pandas dataframe to be downloaded.
+def df_to_csv_bytes(df):
+    """Encode the data in a given pandas dataframe as csv for st.download_button.
     input:  dataframe
-    output: href string
+    output: csv bytes
+    """
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False) # written straight into bytes buffer, no intermediate str
+    return buffer.getvalue()
+
+def show_table(df, heatmap=False):
+    """Display dataframe using streamlit's native table, optionally followed by heatmap styled first rows"""
+    st.dataframe(df, use_container_width=True)
+    if heatmap:
+        st.write(df.head(HEATMAP_ROWS_LIMIT).style.background_gradient(cmap='hot_r'))
+
+def plot_losses(df, losscol, title_suffix=''):
+    """Plot kiln as a strip colored by heat loss, and heat loss along kiln length.
+    Both charts are rendered in the browser by Vega-Lite instead of rasterized on the server.
     """
-    csv = df.to_csv(index=False)
-    b64 = base64.b64encode(csv.encode()).decode()  # some strings <-> bytes conversions necessary here
-    return f'<a href="data:file/csv;base64,{b64}" download="{filename}">{title}</a>'
+    strip = alt.Chart(df, title=f'Colored kiln{title_suffix}').mark_rect().encode(
+        x=alt.X('length:O', title='length'),
+        color=alt.Color(f'{losscol}:Q', scale=alt.Scale(scheme='yelloworangered')),
+    ).properties(height=60)
+    st.altair_chart(strip, use_container_width=True)
+    st.caption(f'Heat loss along kiln length{title_suffix}')
+    st.scatter_chart(df, x='length', y=losscol, color=losscol)
+
+def positions_text(outliers):
+    """Format positions (0 based) of outlier sections as meters, e.g. '3m 4m 10m'"""
+    return ' '.join(np.char.add((outliers + 1).astype(str), 'm'))
 
 class Kiln():
     def __init__(self, diameter, ambient_velocity, ambient_temp, temp_unit, emissivity, interval, df):
@@ -36,29 +69,102 @@ class Kiln():
         columns_count = len(df.columns)
         df.columns = [f'input {i}' for i in range(1, columns_count+1)]
         
-        # compute average of temperatures in input columns
-        average = df[list(df.columns)].sum(axis=1)/columns_count
-        df['temp'] = average if temp_unit=='Kelvin' else average + 273
+        # compute average of temperatures in input columns, empty cells are not counted
+        average = np.nanmean(df.to_numpy(dtype=np.float64), axis=1)
+        # float32 is plenty for measured temperatures and halves memory traffic of the heat loss math
+        df['temp'] = (average if temp_unit=='Kelvin' else average + 273.0).astype(np.float32)
 
         # auto-generate lengths at which readings were taken based on interval and number of readings
         rows_count = len(df.index)
-        length = [i for i in range(interval, interval*rows_count+1, interval)]
-        df.insert(0, 'length', length)
+        df.insert(0, 'length', np.arange(interval, interval*rows_count+1, interval, dtype=np.int64))
 
         self.df = df # Pandas DF with temp readings in Kelvin
 
+        # plain float32 arrays/scalars for the heat loss math
+        self._T = df['temp'].to_numpy(dtype=np.float32)
+        self._Ta = np.float32(self.ambient_temp)
+        self._Ta4 = self._Ta**4
+        self._rad_coef = self.emissivity * self.section_area * STEFAN_BOLTZMANN_CONSTANT
+
+        # scalar factors of the convection correlations, constant per kiln
+        self._conv_mode = 'natural' if ambient_velocity < 3 else 'forced'
+        if self._conv_mode == 'natural':
+            self._natural_const = 80.33 * self.section_area
+        else:
+            # only valid for forced mode, Ta**-0.351 blows up at 0 Kelvin ambient
+            self._forced_const = 28.03 * self._Ta**-0.351 * ambient_velocity**0.805 * diameter**-0.195 * self.section_area
+
+    def _temps(self, tempcol):
+        """Return temperatures (Kelvin) of the given column, or the given temperatures themselves, as a float32 ndarray"""
+        if isinstance(tempcol, str):
+            return self._T if tempcol=='temp' else self.df[tempcol].to_numpy(dtype=np.float32)
+        return np.asarray(tempcol, dtype=np.float32)
+
     def radiation(self, tempcol='temp'):
         """Calculate radiation heat loss (kcal/hr) from each section of kiln"""
-        return self.emissivity * self.section_area * STEFAN_BOLTZMANN_CONSTANT * (self.df[tempcol]**4 - self.ambient_temp**4)
+        T = self._temps(tempcol)
+        return self._rad_coef * (T**4 - self._Ta4)
 
     def convection(self, tempcol='temp'):
         """ Calculate convection heat loss (kcal/hr) from each section of kiln """
-        if self.ambient_velocity < 3:
+        T = self._temps(tempcol)
+        delta = T - self._Ta
+        if self._conv_mode == 'natural':
             # Natural Convection
-            return 80.33 * (((self.df[tempcol] + self.ambient_temp)/2)**-0.724 * (self.df[tempcol] - self.ambient_temp)**1.333) * self.section_area
+            return self._natural_const * ((T + self._Ta) * 0.5)**-0.724 * delta**1.333
         else:
             # Forced Convection
-            return 28.03 * (self.df[tempcol] * self.ambient_temp)**-0.351 * self.ambient_velocity**0.805 * self.diameter**-0.195 * (self.df[tempcol] - self.ambient_temp) * self.section_area
+            return self._forced_const * T**-0.351 * delta
+
+    def heat_loss(self, tempcol='temp'):
+        """Calculate radiation, convection and total heat loss (kcal/hr) from each section of kiln
+        output: (radiation, convection, total) ndarrays
+        """
+        if njit is None:
+            rad = self.radiation(tempcol)
+            conv = self.convection(tempcol)
+            return rad, conv, rad + conv
+        T = self._temps(tempcol)
+        if self._conv_mode == 'natural':
+            return natural_heat_loss(T, self._Ta, self._Ta4, self._rad_coef, self._natural_const)
+        else:
+            return forced_heat_loss(T, self._Ta, self._Ta4, self._rad_coef, self._forced_const)
+
+@st.cache_data
+def load_df(file_bytes):
+    """Parse uploaded excel bytes into a dataframe, cached on the file contents"""
+    # all columns are temperature readings, so skip pandas type inference
+    try:
+        return pd.read_excel(io.BytesIO(file_bytes), header=None, dtype=np.float64, engine=EXCEL_ENGINE)
+    except ValueError:
+        if EXCEL_ENGINE is None:
+            raise
+        # pandas older than 2.2 does not know calamine engine
+        return pd.read_excel(io.BytesIO(file_bytes), header=None, dtype=np.float64)
+
+@st.cache_data
+def compute_kiln(file_bytes, diameter, ambient_velocity, ambient_temp, temp_unit, emissivity, interval, clinker_production):
+    """Build kiln from uploaded excel bytes and compute heat losses (kcal per kg clinker).
+    Cached on the inputs, so reruns caused by unrelated widgets skip the computation.
+    output: (kiln, total heat loss)
+    """
+    df = load_df(file_bytes)
+    kiln = Kiln(diameter, ambient_velocity, ambient_temp, temp_unit, emissivity, interval, df)
+    radiation, convection, total = kiln.heat_loss()
+    kiln.df['radiation'] = pd.Series(radiation/clinker_production, index=kiln.df.index)
+    kiln.df['convection'] = pd.Series(convection/clinker_production, index=kiln.df.index)
+    kiln.df['total loss'] = pd.Series(total/clinker_production, index=kiln.df.index)
+    return kiln, kiln.df['total loss'].sum()
+
+@st.cache_data
+def iqr_whiskers(losses):
+    """Compute IQR whiskers of heat losses.
+    input:  ndarray of heat losses
+    output: (lower whisker, upper whisker)
+    """
+    Q1, Q3 = np.nanpercentile(losses, [25, 75]) # skip NaN losses, like Series.quantile
+    IQR = Q3 - Q1
+    return Q1 - 1.5 * IQR, Q3 + 1.5 * IQR
 
 # input values using streamlit web interface
 diameter = st.sidebar.number_input('Kiln diameter(m)', 0.01, 100.0, 4.75)
@@ -68,6 +174,7 @@ ambient_temp = st.sidebar.number_input('Ambient temperature', 0.0, 373.0, 29.0)
 temp_unit = st.sidebar.selectbox('Unit', ('Celsius', 'Kelvin'))
 emissivity = st.sidebar.slider('emissivity', 0.0, 1.0, 0.77)
 interval = st.sidebar.slider('interval', 1, 10, 1)
+show_heatmap = st.sidebar.checkbox('Show heatmap styling')
 input_excel = st.file_uploader('Upload excel', type=['xls','xlsx','xlsm','xlsb','odf'])
 st.sidebar.subheader('Notes:')
 st.sidebar.info("First meter starts from kiln outlet side")
@@ -76,122 +183,115 @@ st.sidebar.info("Multiple temperature readings can be provided at each point by
 st.sidebar.info("Fill columns in input Excel starting from column A and use columns B,C,D,... as required. Columns should contain only the temperature readings in numbers and nothing else, not even column headers")
 
 if input_excel is not None:
-    df = pd.read_excel(input_excel, header=None)
-    kiln = Kiln(diameter, ambient_velocity, ambient_temp, temp_unit, emissivity, interval, df)
-    
     # compute & plot data
-    kiln.df['radiation'] = kiln.radiation()/clinker_production
-    kiln.df['convection'] = kiln.convection()/clinker_production
-    kiln.df['total loss'] = kiln.df['radiation'] + kiln.df['convection']
-    st.write(kiln.df.style.background_gradient(cmap='hot_r'))
-    df.plot.scatter('length', 'length',c = 'total loss', cmap='hot_r', colorbar=True, title='Colored kiln')
-    st.pyplot()
-    df.plot.scatter('length', 'total loss',c = 'total loss', cmap='hot_r', colorbar=True, title='Heat loss along kiln length')
-    st.pyplot()
-    total_loss = df['total loss'].sum()
+    kiln, total_loss = compute_kiln(input_excel.getvalue(), diameter, ambient_velocity, ambient_temp, temp_unit, emissivity, interval, clinker_production)
+    df = kiln.df
+    show_table(kiln.df, show_heatmap)
+    plot_losses(df, 'total loss')
     st.subheader(f'Total heat loss = {total_loss:.2f} KCal per Kg clinker')
 
     # make a copy of dataframe till here
     df_copy = df.copy()
     
-    # find outliers
-    Q1 = df['total loss'].quantile(0.25)
-    Q3 = df['total loss'].quantile(0.75)
-    IQR = Q3 - Q1
-    upper_whisker = Q3 + 1.5 * IQR
-    lower_whisker = Q1 - 1.5 * IQR
-    st.subheader('High outliers:')
-    st.write(df[df['total loss'] > upper_whisker].style.hide_index())
-    st.subheader('Low outliers:')
-    st.write(df[df['total loss'] < lower_whisker].style.hide_index())
-    high_outliers = []
-    low_outliers = []
-    for index,loss in df['total loss'].iteritems():
-        if loss > upper_whisker:
-            high_outliers.append(index)
-        if loss < lower_whisker:
-            low_outliers.append(index)
-    
-    if len(high_outliers) > 0:
-        # median of temperatures which do not correspond to outliers
-        mediantemp = df['temp'].drop(high_outliers).drop(low_outliers).median()
-        df['new temp'] = df['temp']
-        # replace temperatures corresponding to high outliers with above computed median
-        for index in high_outliers:
-            df.loc[index,'new temp'] = mediantemp
-
-        # recompute and plot data
-        st.subheader('After repairs:')
-        df['new radiation'] = kiln.radiation('new temp')/clinker_production
-        df['new convection'] = kiln.convection('new temp')/clinker_production
-        df['new total loss'] = df['new radiation'] + df['new convection']
-        st.write(kiln.df.style.background_gradient(cmap='hot_r'))
-        df.plot.scatter('length', 'length',c = 'new total loss', cmap='hot_r', colorbar=True, title='Colored kiln after repairs')
-        st.pyplot()
-        df.plot.scatter('length', 'new total loss',c = 'new total loss', cmap='hot_r', colorbar=True, title='Heat loss along kiln length after repairs')
-        st.pyplot()
-        new_total_loss = df['new total loss'].sum()
-        st.subheader(f'Total heat loss after removing high outliers= {new_total_loss:.2f} KCal per Kg clinker')
-
-        savings = total_loss - new_total_loss
-        if savings > 0.0:
-            # compute savings per year due to repairs
-            savings_per_hour = savings * clinker_production
-            WORKING_DAYS_PER_YEAR = 330
-            working_hours_per_year = WORKING_DAYS_PER_YEAR * 24
-            savings_per_year = savings_per_hour * working_hours_per_year
-            COAL_CALORIFIC_VALUE = 4500 # kcal/Kg
-            coal_saved_per_year = savings_per_year / COAL_CALORIFIC_VALUE
-            coal_saved_per_year_tons = coal_saved_per_year/1000
-            COAL_COST_PER_TON = 4500 # rupees
-            money_saved_per_year = coal_saved_per_year_tons * COAL_COST_PER_TON
-
-            # compute repair costs
-            kiln_length_damaged = len(high_outliers)
-            RINGS_PER_METER = 5
-            SHELL_THICKNESS = 16 # mm
-            BRICK_HEIGHT = 220 # mm
-            BRICK_COST = 100
-            internal_diameter = kiln.diameter * 1000 - 2 * SHELL_THICKNESS # mm
-            bricks_per_ring = math.floor(3.14*(internal_diameter - BRICK_HEIGHT)/71.5)
-            bricks_per_meter = bricks_per_ring * RINGS_PER_METER
-            bricks_damaged_count = bricks_per_meter * kiln_length_damaged
-            repair_cost = bricks_damaged_count * BRICK_COST
+    if len(df) < MIN_READINGS_FOR_IQR:
+        # quartiles of so few readings are meaningless, skip outlier detection and repairs
+        st.header('Summary:')
+        st.subheader(f'Total heat loss = {total_loss:.2f} KCal per Kg clinker')
+        st.subheader(f'At least {MIN_READINGS_FOR_IQR} readings are needed to identify outliers')
+    else:
+        # find outliers
+        losses = df['total loss'].to_numpy()
+        lower_whisker, upper_whisker = iqr_whiskers(losses)
+        mask_hi = losses > upper_whisker
+        mask_lo = losses < lower_whisker
+        high_outliers = np.flatnonzero(mask_hi)
+        low_outliers = np.flatnonzero(mask_lo)
+        st.subheader('High outliers:')
+        st.dataframe(df[mask_hi], hide_index=True)
+        st.subheader('Low outliers:')
+        st.dataframe(df[mask_lo], hide_index=True)
+
+        if len(high_outliers) > 0:
+            # median of temperatures which do not correspond to outliers
+            mediantemp = np.nanmedian(df['temp'].to_numpy()[~(mask_hi | mask_lo)])
+            # replace temperatures corresponding to high outliers with above computed median
+            df['new temp'] = np.where(mask_hi, mediantemp, df['temp'].to_numpy())
+
+            # recompute and plot data
+            st.subheader('After repairs:')
+            # only high outlier sections change, so patch old losses with the losses at median temperature
+            median_radiation = kiln.radiation(mediantemp)/clinker_production
+            median_convection = kiln.convection(mediantemp)/clinker_production
+            new_radiation = df['radiation'].to_numpy().copy()
+            new_radiation[mask_hi] = median_radiation
+            new_convection = df['convection'].to_numpy().copy()
+            new_convection[mask_hi] = median_convection
+            df['new radiation'] = pd.Series(new_radiation, index=df.index)
+            df['new convection'] = pd.Series(new_convection, index=df.index)
+            df['new total loss'] = pd.Series(new_radiation + new_convection, index=df.index)
+            show_table(kiln.df, show_heatmap)
+            plot_losses(df, 'new total loss', ' after repairs')
+            new_total_loss = df['new total loss'].sum()
+            st.subheader(f'Total heat loss after removing high outliers= {new_total_loss:.2f} KCal per Kg clinker')
+
+            savings = total_loss - new_total_loss
+            if savings > 0.0:
+                # compute savings per year due to repairs
+                savings_per_hour = savings * clinker_production
+                WORKING_DAYS_PER_YEAR = 330
+                working_hours_per_year = WORKING_DAYS_PER_YEAR * 24
+                savings_per_year = savings_per_hour * working_hours_per_year
+                COAL_CALORIFIC_VALUE = 4500 # kcal/Kg
+                coal_saved_per_year = savings_per_year / COAL_CALORIFIC_VALUE
+                coal_saved_per_year_tons = coal_saved_per_year/1000
+                COAL_COST_PER_TON = 4500 # rupees
+                money_saved_per_year = coal_saved_per_year_tons * COAL_COST_PER_TON
+
+                # compute repair costs
+                kiln_length_damaged = len(high_outliers)
+                RINGS_PER_METER = 5
+                SHELL_THICKNESS = 16 # mm
+                BRICK_HEIGHT = 220 # mm
+                BRICK_COST = 100
+                internal_diameter = kiln.diameter * 1000 - 2 * SHELL_THICKNESS # mm
+                bricks_per_ring = int(math.pi * (internal_diameter - BRICK_HEIGHT) / 71.5)
+                bricks_per_meter = bricks_per_ring * RINGS_PER_METER
+                bricks_damaged_count = bricks_per_meter * kiln_length_damaged
+                repair_cost = bricks_damaged_count * BRICK_COST
             
-            # compute net savings
-            savings_per_year_rupees = money_saved_per_year - repair_cost
+                # compute net savings
+                savings_per_year_rupees = money_saved_per_year - repair_cost
 
+                # print summary
+                st.header('Summary:')
+                st.subheader(f'Total heat loss = {total_loss:.2f} KCal per Kg clinker')
+                if len(low_outliers) > 0:
+                    low_outliers_text = positions_text(low_outliers)
+                    st.subheader(f'Coating formation suspected at:')
+                    st.write(low_outliers_text)
+                else:
+                    st.subheader(f'No Coating formation suspected')            
+                high_outliers_text = positions_text(high_outliers)
+                st.subheader(f'{kiln_length_damaged} meters of kiln was found to be damaged at:')
+                st.write(high_outliers_text)
+                st.subheader('On repairing:')
+                st.subheader(f'About {savings:.2f} KCal can be saved for each Kg clinker produced')
+                st.subheader(f'{savings_per_year_rupees/10**5:.2f} lakh rupees can be saved per year')
+            else:
+                # high outliers are replaced but savings are not positive
+                # This is not supposed to happen
+                st.subheader(f'Total heat loss after removing high outliers seems to be more than earlier. Something is wrong...')
+        else:
             # print summary
             st.header('Summary:')
             st.subheader(f'Total heat loss = {total_loss:.2f} KCal per Kg clinker')
+            st.subheader('No high outliers found')
             if len(low_outliers) > 0:
-                low_outliers_text = ''.join([f'{x+1}m ' for x in low_outliers])
+                low_outliers_text = positions_text(low_outliers)
                 st.subheader(f'Coating formation suspected at:')
                 st.write(low_outliers_text)
             else:
-                st.subheader(f'No Coating formation suspected')            
-            high_outliers_text = ''.join([f'{x+1}m ' for x in high_outliers])
-            st.subheader(f'{kiln_length_damaged} meters of kiln was found to be damaged at:')
-            st.write(high_outliers_text)
-            st.subheader('On repairing:')
-            st.subheader(f'About {savings:.2f} KCal can be saved for each Kg clinker produced')
-            st.subheader(f'{savings_per_year_rupees/10**5:.2f} lakh rupees can be saved per year')
-        else:
-            # high outliers are replaced but savings are not positive
-            # This is not supposed to happen
-            st.subheader(f'Total heat loss after removing high outliers seems to be more than earlier. Something is wrong...')
-    else:
-        # print summary
-        st.header('Summary:')
-        st.subheader(f'Total heat loss = {total_loss:.2f} KCal per Kg clinker')
-        st.subheader('No high outliers found')
-        if len(low_outliers) > 0:
-            low_outliers_text = ''.join([f'{x+1}m ' for x in low_outliers])
-            st.subheader(f'Coating formation suspected at:')
-            st.write(low_outliers_text)
-        else:
-            st.subheader(f'No Coating formation suspected')
+                st.subheader(f'No Coating formation suspected')
 
     # download heat loss calculations as csv
-    download_link = df_to_link(df_copy, title='Download calculations', filename='calculations.csv')
-    st.markdown(download_link, unsafe_allow_html=True)
\ No newline at end of file
+    st.download_button('Download calculations', data=df_to_csv_bytes(df_copy), file_name='calculations.csv', mime='text/csv')
\ No newline at end of file